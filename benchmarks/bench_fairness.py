@@ -0,0 +1,47 @@
+"""Synthetic abuse benchmark for the webhook FairnessGate.
+
+One abusive user floods messages while normal users send a few each; prints
+admission counts per class and gate throughput.
+
+    python benchmarks/bench_fairness.py [abusive_msgs] [normal_users]
+"""
+import asyncio
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from multi_tool_agent.fairness import FairnessGate  # noqa: E402
+
+
+async def main(abusive_msgs: int = 100_000, normal_users: int = 1_000) -> None:
+    gate = FairnessGate(per_user_limit=5, window_seconds=60, max_in_flight=20)
+    traffic = [("abuser", True)] * abusive_msgs + [
+        (f"user{i}", False) for i in range(normal_users) for _ in range(3)
+    ]
+    random.seed(0)
+    random.shuffle(traffic)
+
+    admitted = {True: 0, False: 0}
+    in_flight: list[int] = []
+    started = time.perf_counter()
+    for user_id, abusive in traffic:
+        if (await gate.admit(user_id, "msg")).text is not None:
+            admitted[abusive] += 1
+            in_flight.append(1)
+        # Complete requests at roughly the arrival rate to keep the cap busy
+        if len(in_flight) >= 10:
+            gate.release()
+            in_flight.pop()
+    elapsed = time.perf_counter() - started
+
+    print(f"messages:        {len(traffic)}")
+    print(f"abuser admitted: {admitted[True]} / {abusive_msgs}")
+    print(f"normal admitted: {admitted[False]} / {normal_users * 3}")
+    print(f"throughput:      {len(traffic) / elapsed:,.0f} admits/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(*(int(a) for a in sys.argv[1:3])))
@@ -2,17 +2,23 @@
 import os
 import sys
 import uuid
+from email.utils import parsedate_to_datetime
 
 import aiohttp
 from fastapi import Request, FastAPI, HTTPException
-from fastapi.responses import Response
+from fastapi.responses import FileResponse, Response
 
 from linebot.models import MessageEvent, TextSendMessage, ImageSendMessage
 from linebot.exceptions import InvalidSignatureError
 from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
 from linebot import AsyncLineBotApi, WebhookParser
 
-from multi_tool_agent.ecommerce_agent import EcommerceAgent
+from multi_tool_agent import metrics
+from multi_tool_agent.dedup import EventDeduplicator
+from multi_tool_agent.ecommerce_agent import EcommerceAgent, set_state_store
+from multi_tool_agent.fairness import THROTTLED_GLOBAL, FairnessGate
+from multi_tool_agent.rate_limiter import RateLimitExceeded
+from multi_tool_agent.state import StoreMapping, create_store, offload
 
 # ── Environment Variables ─────────────────────────────────────────────────────
 channel_secret = os.getenv("ChannelSecret")
@@ -23,6 +29,25 @@ GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY", "")
 GOOGLE_CLOUD_PROJECT = os.getenv("GOOGLE_CLOUD_PROJECT", "")
 GOOGLE_CLOUD_LOCATION = os.getenv("GOOGLE_CLOUD_LOCATION", "us-central1")
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-3.1-pro-preview")
+GEMINI_FALLBACK_MODEL = os.getenv("GEMINI_FALLBACK_MODEL") or None
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "0"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "0"))
+GEMINI_MAX_QUEUE = int(os.getenv("GEMINI_MAX_QUEUE", "100"))
+AGENT_LATENCY_BUDGET = float(os.getenv("AGENT_LATENCY_BUDGET", "25"))
+AGENT_FINAL_ANSWER_RESERVE = float(os.getenv("AGENT_FINAL_ANSWER_RESERVE", "8"))
+USER_RATE_LIMIT = int(os.getenv("USER_RATE_LIMIT", "5"))
+USER_RATE_WINDOW = float(os.getenv("USER_RATE_WINDOW", "60"))
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", "20"))
+EVENT_DEDUP_TTL = float(os.getenv("EVENT_DEDUP_TTL", "600"))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+# 預設放在程式目錄而非所有人可寫入的 /tmp：讀回的值會經過 pickle.loads
+STATE_SQLITE_PATH = os.getenv("STATE_SQLITE_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "linebot-state.db"
+)
+STATE_REDIS_URL = os.getenv("STATE_REDIS_URL", "")
+IMAGE_CACHE_TTL = float(os.getenv("IMAGE_CACHE_TTL", "86400"))
+HISTORY_TTL = float(os.getenv("HISTORY_TTL", "86400"))
 
 if not channel_secret:
     print("ERROR: ChannelSecret is required.")
@@ -39,6 +64,23 @@ if USE_VERTEX and not GOOGLE_CLOUD_PROJECT:
 if not USE_VERTEX and not GOOGLE_API_KEY:
     print("ERROR: GOOGLE_API_KEY is required.")
     sys.exit(1)
+if not 0 <= AGENT_FINAL_ANSWER_RESERVE < AGENT_LATENCY_BUDGET:
+    print("ERROR: AGENT_FINAL_ANSWER_RESERVE must be >= 0 and below AGENT_LATENCY_BUDGET.")
+    sys.exit(1)
+if STATE_BACKEND not in ("memory", "sqlite", "redis"):
+    print("ERROR: STATE_BACKEND must be memory, sqlite or redis.")
+    sys.exit(1)
+if STATE_BACKEND == "redis" and not STATE_REDIS_URL:
+    print("ERROR: STATE_REDIS_URL is required when STATE_BACKEND=redis")
+    sys.exit(1)
+if WEB_CONCURRENCY > 1 and STATE_BACKEND == "memory":
+    print("ERROR: WEB_CONCURRENCY > 1 requires STATE_BACKEND=sqlite or redis.")
+    sys.exit(1)
+
+# ── Shared state (images, histories, orders, dedup, rate limits) ──────────────
+state_store = create_store(STATE_BACKEND, STATE_SQLITE_PATH, STATE_REDIS_URL)
+set_state_store(state_store)
+print(f"State backend: {STATE_BACKEND} (workers={WEB_CONCURRENCY})")
 
 # ── FastAPI + LINE Bot ────────────────────────────────────────────────────────
 app = FastAPI()
@@ -61,34 +103,124 @@ def get_line_bot_api() -> AsyncLineBotApi:
 parser = WebhookParser(channel_secret)
 
 # ── EcommerceAgent ────────────────────────────────────────────────────────────
+def _per_worker(total: int) -> int:
+    """Split a deployment-wide limit evenly between workers (0 stays unlimited)."""
+    if total <= 0:
+        return total
+    return max(1, total // WEB_CONCURRENCY)
+
+
+# 每個 worker 各自排程 Gemini 呼叫，配額與佇列上限依 worker 數平均分配
+_agent_options = dict(
+    rpm=_per_worker(GEMINI_RPM),
+    tpm=_per_worker(GEMINI_TPM),
+    max_queue=_per_worker(GEMINI_MAX_QUEUE),
+    fallback_model=GEMINI_FALLBACK_MODEL,
+    store=state_store,
+    history_ttl=HISTORY_TTL,
+    latency_budget=AGENT_LATENCY_BUDGET,
+    final_answer_reserve=AGENT_FINAL_ANSWER_RESERVE,
+)
 if USE_VERTEX:
     ecommerce_agent = EcommerceAgent(
         vertexai=True,
         project=GOOGLE_CLOUD_PROJECT,
         location=GOOGLE_CLOUD_LOCATION,
         model=GEMINI_MODEL,
+        **_agent_options,
     )
 else:
     ecommerce_agent = EcommerceAgent(
         api_key=GOOGLE_API_KEY,
         model=GEMINI_MODEL,
+        **_agent_options,
     )
 
 print(f"EcommerceAgent initialized (model={GEMINI_MODEL}, vertex={USE_VERTEX})")
 
-# ── In-memory image cache ─────────────────────────────────────────────────────
-image_cache: dict[str, bytes] = {}
+# ── Per-user / global fairness limits ─────────────────────────────────────────
+fairness = FairnessGate(
+    per_user_limit=USER_RATE_LIMIT,
+    window_seconds=USER_RATE_WINDOW,
+    max_in_flight=MAX_IN_FLIGHT,
+    store=state_store if state_store.shared else None,
+)
+THROTTLED_REPLY = "訊息有點多，我會在您的下一則訊息一併回覆，請稍候再傳送。"
+BUSY_REPLY = "目前詢問人數眾多，我會在您的下一則訊息一併回覆，請稍後再試。"
+
+# ── Webhook redelivery deduplication ───────────────────────────────────────────
+# in-progress 只保留「處理時間上限 + 回覆時間」，worker 當掉時重送仍能被處理
+event_dedup = EventDeduplicator(
+    ttl_seconds=EVENT_DEDUP_TTL,
+    lease_seconds=AGENT_LATENCY_BUDGET + 30,
+    store=state_store if state_store.shared else None,
+)
+
+# ── Image cache (served by whichever worker LINE hits) ─────────────────────────
+image_cache = StoreMapping(state_store, "image", ttl=IMAGE_CACHE_TTL)
 
 
 # ── Endpoints ─────────────────────────────────────────────────────────────────
 
+def _sniff_image_type(data: bytes) -> str:
+    """Guess the image MIME type from magic bytes (defaults to JPEG)."""
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+def _is_not_modified(request_headers, response_headers) -> bool:
+    """Conditional GET check (If-None-Match first, then If-Modified-Since)."""
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        etags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in etags or response_headers["etag"] in etags
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return parsedate_to_datetime(
+                response_headers["last-modified"]
+            ) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
 @app.get("/images/{image_id}")
-async def serve_image(image_id: str):
-    """Serve cached product images for LINE Bot display."""
-    image_bytes = image_cache.get(image_id)
-    if image_bytes is None:
+async def serve_image(image_id: str, request: Request):
+    """Serve cached product images for LINE Bot display.
+
+    File-backed images are streamed by FileResponse (Range requests,
+    ETag / Last-Modified, 304 on conditional GET); other images are served
+    from the cached bytes.
+    """
+    image = await offload(state_store, image_cache.get, image_id)
+    if image is None:
         raise HTTPException(status_code=404, detail="Image not found")
-    return Response(content=image_bytes, media_type="image/jpeg")
+    if isinstance(image, bytes):
+        return Response(content=image, media_type=_sniff_image_type(image))
+
+    try:
+        stat_result = os.stat(image)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Image not found")
+    response = FileResponse(image, stat_result=stat_result)
+    if _is_not_modified(request.headers, response.headers):
+        return Response(
+            status_code=304,
+            headers={k: response.headers[k] for k in ("etag", "last-modified")},
+        )
+    return response
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Export process-local counters (queue wait, rejections, retries...)."""
+    return metrics.snapshot()
 
 
 @app.post("/")
@@ -108,32 +240,68 @@ async def handle_callback(request: Request):
         if event.message.type != "text":
             continue
 
-        msg_text = event.message.text
-        line_user_id = event.source.user_id
-        print(f"[MSG] user={line_user_id}: {msg_text}")
+        event_id = event.webhook_event_id
+        if event_id and not await offload(state_store, event_dedup.begin, event_id):
+            metrics.incr("webhook_redelivery_skipped")
+            print(f"[DEDUP] skip {event_id}")
+            continue
 
         try:
-            ai_text, image_bytes = await ecommerce_agent.process_message(
-                msg_text, line_user_id
-            )
-        except Exception as e:
-            print(f"[ERROR] Agent error: {e}")
-            ai_text = "抱歉，系統發生錯誤，請稍後再試。"
-            image_bytes = None
-
-        reply_messages = [TextSendMessage(text=ai_text)]
-
-        if image_bytes:
-            image_id = str(uuid.uuid4())
-            image_cache[image_id] = image_bytes
-            image_url = f"{BOT_HOST_URL}/images/{image_id}"
-            reply_messages.append(
-                ImageSendMessage(
-                    original_content_url=image_url,
-                    preview_image_url=image_url,
-                )
-            )
-
-        await get_line_bot_api().reply_message(event.reply_token, reply_messages)
+            await _handle_text_event(event)
+        except Exception:
+            if event_id:
+                await offload(state_store, event_dedup.forget, event_id)
+            raise
+        if event_id:
+            await offload(state_store, event_dedup.complete, event_id)
 
     return "OK"
+
+
+async def _handle_text_event(event: MessageEvent) -> None:
+    """Run the agent for one text message event and reply to it."""
+    msg_text = event.message.text
+    line_user_id = event.source.user_id
+    print(f"[MSG] user={line_user_id}: {msg_text}")
+
+    admitted_text, throttled = await fairness.admit(line_user_id, msg_text)
+    if admitted_text is None:
+        print(f"[THROTTLE] user={line_user_id} ({throttled})")
+        reply_text = BUSY_REPLY if throttled == THROTTLED_GLOBAL else THROTTLED_REPLY
+        await get_line_bot_api().reply_message(
+            event.reply_token, [TextSendMessage(text=reply_text)]
+        )
+        return
+
+    try:
+        ai_text, image_bytes, image_path = await ecommerce_agent.reply(
+            admitted_text, line_user_id
+        )
+    except RateLimitExceeded as e:
+        print(f"[BUSY] Agent rejected: {e}")
+        ai_text = "目前詢問人數眾多，請稍後再試。"
+        image_bytes = image_path = None
+    except Exception as e:
+        print(f"[ERROR] Agent error: {e}")
+        ai_text = "抱歉，系統發生錯誤，請稍後再試。"
+        image_bytes = image_path = None
+    finally:
+        fairness.release()
+
+    reply_messages = [TextSendMessage(text=ai_text)]
+
+    if image_bytes:
+        image_id = str(uuid.uuid4())
+        # 有檔案的商品圖只存路徑，由 serve_image 直接從檔案串流
+        await offload(
+            state_store, image_cache.__setitem__, image_id, image_path or image_bytes
+        )
+        image_url = f"{BOT_HOST_URL}/images/{image_id}"
+        reply_messages.append(
+            ImageSendMessage(
+                original_content_url=image_url,
+                preview_image_url=image_url,
+            )
+        )
+
+    await get_line_bot_api().reply_message(event.reply_token, reply_messages)
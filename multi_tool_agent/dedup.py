@@ -0,0 +1,46 @@
+# multi_tool_agent/dedup.py
+import time
+
+from multi_tool_agent.state import MemoryStore, StateStore
+
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+
+_NAMESPACE = "webhook_event"
+
+
+class EventDeduplicator:
+    """Remember webhookEventIds for ttl_seconds to drop LINE redeliveries.
+
+    begin() claims an event and marks it in progress for lease_seconds;
+    complete() marks it done for ttl_seconds, forget() releases the claim so
+    a later redelivery is processed again (used when handling failed). The
+    short lease means a claim left behind by a crashed worker expires in time
+    for LINE's next redelivery. Without a shared store, entries live
+    in process memory and at most max_entries are kept, oldest evicted first.
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: float = 600,
+        lease_seconds: float = 60,
+        max_entries: int = 10_000,
+        clock=time.monotonic,
+        store: StateStore | None = None,
+    ):
+        self._ttl = ttl_seconds
+        self._lease = lease_seconds
+        self._store = store or MemoryStore(max_entries=max_entries, clock=clock)
+
+    def state(self, event_id: str) -> str | None:
+        return self._store.get(_NAMESPACE, event_id)
+
+    def begin(self, event_id: str) -> bool:
+        """Claim event_id. Returns False if it is in progress or completed."""
+        return self._store.add(_NAMESPACE, event_id, IN_PROGRESS, ttl=self._lease)
+
+    def complete(self, event_id: str) -> None:
+        self._store.set(_NAMESPACE, event_id, COMPLETED, ttl=self._ttl)
+
+    def forget(self, event_id: str) -> None:
+        self._store.delete(_NAMESPACE, event_id)
@@ -1,7 +1,14 @@
 # multi_tool_agent/ecommerce_agent.py
+import asyncio
 import copy
 import datetime
+import hashlib
+import json
+import time
 from pathlib import Path
+from typing import NamedTuple
+
+from multi_tool_agent.state import MemoryStore, StateStore, offload
 
 # ── 商品圖片目錄 ──────────────────────────────────────────────────────────────
 _IMG_DIR = Path(__file__).parent.parent / "img"
@@ -82,15 +89,31 @@ _DEMO_ORDERS_TEMPLATE = [
     },
 ]
 
-# Per-user 訂單綁定（line_user_id → list[Order]）
-_user_orders: dict[str, list[dict]] = {}
+# Per-user 訂單綁定（line_user_id → list[Order]），多 worker 時改用共享 store
+_state_store: StateStore = MemoryStore()
+
+
+def set_state_store(store: StateStore) -> None:
+    """設定訂單綁定使用的 store（多 worker 部署時設為共享 store）。"""
+    global _state_store
+    _state_store = store
 
 
 def get_user_orders(line_user_id: str) -> list[dict]:
     """第一次呼叫時自動綁定 demo 訂單到此 user_id。"""
-    if line_user_id not in _user_orders:
-        _user_orders[line_user_id] = copy.deepcopy(_DEMO_ORDERS_TEMPLATE)
-    return _user_orders[line_user_id]
+    orders = _state_store.get("orders", line_user_id)
+    if orders is None:
+        _state_store.add(
+            "orders", line_user_id, copy.deepcopy(_DEMO_ORDERS_TEMPLATE)
+        )
+        orders = _state_store.get("orders", line_user_id)
+    return orders
+
+
+def catalog_version() -> str:
+    """商品目錄版本（PRODUCTS_DB 內容雜湊），目錄異動時自動改變。"""
+    payload = json.dumps(PRODUCTS_DB, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode()).hexdigest()[:12]
 
 
 # ── 商品圖片讀取 ──────────────────────────────────────────────────────────────
@@ -196,6 +219,14 @@ def get_product_details(product_id: str) -> dict:
 from google import genai
 from google.genai import types
 
+from multi_tool_agent import metrics
+from multi_tool_agent.rate_limiter import (
+    PRIORITY_FIRST_TURN,
+    PRIORITY_FOLLOW_UP,
+    GeminiScheduler,
+)
+from multi_tool_agent.singleflight import SingleFlight
+
 # ── Gemini 工具宣告 ───────────────────────────────────────────────────────────
 ECOMMERCE_TOOLS = [
     types.Tool(function_declarations=[
@@ -259,10 +290,56 @@ _SYSTEM_INSTRUCTION = """你是一位友善專業的電商客服助理。
 請務必用繁體中文回答，並保持親切、專業的態度。"""
 
 
+# 最後一輪停用工具呼叫，強制模型根據已取得的工具結果直接回答
+_NO_TOOL_CALLS = types.ToolConfig(
+    function_calling_config=types.FunctionCallingConfig(
+        mode=types.FunctionCallingConfigMode.NONE
+    )
+)
+
+# 結果與 line_user_id 相關的工具；呼叫過這些工具的回答不可共享給其他用戶
+_USER_SCOPED_TOOLS = {"get_order_history"}
+
+
+def _strip_inline_images(content: types.Content) -> types.Content:
+    """移除函式回應中夾帶的圖片 bytes（寫入共享 store 前使用，避免每則訊息寫入數 MB）。"""
+    parts = []
+    stripped = False
+    for part in content.parts or []:
+        fr = part.function_response
+        if fr is not None and fr.parts:
+            part = part.model_copy(
+                update={"function_response": fr.model_copy(update={"parts": None})}
+            )
+            stripped = True
+        parts.append(part)
+    return content.model_copy(update={"parts": parts}) if stripped else content
+
+
+def _normalize_query(text: str) -> str:
+    """正規化用戶訊息（去除多餘空白、忽略大小寫），作為共享請求的 key。"""
+    return " ".join(text.split()).casefold()
+
+
+class _LoopResult(NamedTuple):
+    contents: list[types.Content]
+    text: str
+    image: bytes | None
+    image_path: str | None
+    user_scoped: bool
+
+
+class AgentReply(NamedTuple):
+    """Agent answer; image_path is the file behind image when it has one."""
+    text: str
+    image: bytes | None
+    image_path: str | None
+
+
 def _execute_tool(
     func_name: str, func_args: dict, line_user_id: str
-) -> tuple[dict, bytes | None]:
-    """Execute a tool function. Returns (result_dict, image_bytes | None)."""
+) -> tuple[dict, bytes | None, str | None]:
+    """Execute a tool function. Returns (result_dict, image_bytes, image_path)."""
     primary_product_id: str | None = None
 
     if func_name == "search_products":
@@ -279,10 +356,13 @@ def _execute_tool(
         result = {"status": "error", "message": f"未知工具：{func_name}"}
 
     image_bytes: bytes | None = None
+    image_path: str | None = None
     if primary_product_id and primary_product_id in PRODUCTS_DB:
-        image_bytes = generate_product_image(PRODUCTS_DB[primary_product_id])
+        product = PRODUCTS_DB[primary_product_id]
+        image_bytes = generate_product_image(product)
+        image_path = product["image_path"]
 
-    return result, image_bytes
+    return result, image_bytes, image_path
 
 
 class EcommerceAgent:
@@ -295,7 +375,20 @@ class EcommerceAgent:
         project: str | None = None,
         location: str | None = None,
         model: str = "gemini-2.0-flash",
+        rpm: int = 0,
+        tpm: int = 0,
+        max_queue: int = 100,
+        fallback_model: str | None = None,
+        store: StateStore | None = None,
+        history_ttl: float = 86400,
+        latency_budget: float = 25.0,
+        final_answer_reserve: float = 8.0,
+        max_iterations: int = 5,
     ):
+        if not 0 <= final_answer_reserve < latency_budget:
+            raise ValueError(
+                "final_answer_reserve must be >= 0 and below latency_budget"
+            )
         if vertexai:
             self._client = genai.Client(
                 vertexai=True, project=project, location=location
@@ -303,50 +396,133 @@ class EcommerceAgent:
         else:
             self._client = genai.Client(api_key=api_key)
         self._model = model
-        self._histories: dict[str, list[types.Content]] = {}
+        self._scheduler = GeminiScheduler(
+            self._client,
+            rpm=rpm,
+            tpm=tpm,
+            max_queue=max_queue,
+            fallback_model=fallback_model,
+        )
+        self._store = store or MemoryStore()
+        self._history_ttl = history_ttl
+        self._inflight = SingleFlight()
+        self._latency_budget = latency_budget
+        self._final_answer_reserve = final_answer_reserve
+        self._max_iterations = max_iterations
 
     def _get_history(self, user_id: str) -> list[types.Content]:
-        return self._histories.get(user_id, [])
+        return self._store.get("history", user_id) or []
 
     def _save_history(self, user_id: str, contents: list[types.Content]) -> None:
-        self._histories[user_id] = contents[-20:]
+        history = contents[-20:]
+        if self._store.shared:
+            history = [_strip_inline_images(c) for c in history]
+        self._store.set("history", user_id, history, ttl=self._history_ttl)
 
     async def process_message(
         self, text: str, line_user_id: str
     ) -> tuple[str, bytes | None]:
         """Process a user message. Returns (ai_text, main_image_bytes | None)."""
-        history = self._get_history(line_user_id)
+        reply = await self.reply(text, line_user_id)
+        return reply.text, reply.image
+
+    async def reply(self, text: str, line_user_id: str) -> AgentReply:
+        """Process a user message and return text, image and image file path.
+
+        First-turn messages (no history) are coalesced: concurrent identical
+        queries against the same catalog version share one agent loop. If that
+        loop touched user-scoped data, waiters re-run it for their own user.
+        The latency budget covers the whole message, including that re-run.
+        """
+        deadline = time.monotonic() + self._latency_budget
+        history = await offload(self._store, self._get_history, line_user_id)
         user_content = types.Content(role="user", parts=[types.Part(text=text)])
-        contents = history + [user_content]
 
+        if history:
+            result = await self._run_loop(
+                history + [user_content], line_user_id, deadline
+            )
+        else:
+            key = (_normalize_query(text), catalog_version())
+            result, shared = await self._inflight.do(
+                key, lambda: self._run_loop([user_content], line_user_id, deadline)
+            )
+            if shared and result.user_scoped:
+                result = await self._run_loop([user_content], line_user_id, deadline)
+
+        await offload(self._store, self._save_history, line_user_id, result.contents)
+        return AgentReply(result.text, result.image, result.image_path)
+
+    async def _run_loop(
+        self, contents: list[types.Content], line_user_id: str, deadline: float
+    ) -> _LoopResult:
+        """Run the Gemini tool-calling loop on contents (mutated in place).
+
+        The loop must finish by deadline (time.monotonic()). Tool-calling rounds
+        must finish before only final_answer_reserve seconds are left; the
+        last round (by time or by max_iterations) runs with tool calls
+        disabled so the model answers from the tool results it already has.
+        """
         final_text = "抱歉，我暫時無法處理您的請求，請稍後再試。"
         final_image: bytes | None = None
+        final_image_path: str | None = None
+        user_scoped = False
+        started = time.monotonic()
+
+        for iteration in range(self._max_iterations):
+            remaining = deadline - time.monotonic()
+            out_of_time = remaining <= self._final_answer_reserve
+            final = out_of_time or iteration == self._max_iterations - 1
+            if final:
+                metrics.incr(
+                    "agent_forced_answer_budget" if out_of_time
+                    else "agent_forced_answer_iterations"
+                )
 
-        for _iteration in range(5):
-            response = await self._client.aio.models.generate_content(
-                model=self._model,
-                contents=contents,
-                config=types.GenerateContentConfig(
-                    system_instruction=_SYSTEM_INSTRUCTION,
-                    tools=ECOMMERCE_TOOLS,
-                ),
-            )
+            priority = PRIORITY_FIRST_TURN if iteration == 0 else PRIORITY_FOLLOW_UP
+            timeout = remaining if final else remaining - self._final_answer_reserve
+            try:
+                response = await asyncio.wait_for(
+                    self._scheduler.generate_content(
+                        model=self._model,
+                        priority=priority,
+                        contents=contents,
+                        config=types.GenerateContentConfig(
+                            system_instruction=_SYSTEM_INSTRUCTION,
+                            tools=ECOMMERCE_TOOLS,
+                            tool_config=_NO_TOOL_CALLS if final else None,
+                        ),
+                    ),
+                    timeout=max(0.0, timeout),
+                )
+            except asyncio.TimeoutError:
+                if final:
+                    metrics.incr("agent_deadline_exceeded")
+                    print(f"[Agent] deadline exceeded after {iteration + 1} rounds")
+                    break
+                # 剩下的時間只夠最後一輪，下一輪會停用工具直接回答
+                metrics.incr("agent_iteration_timeout")
+                continue
 
             candidate = response.candidates[0]
             model_content = candidate.content
-            contents.append(model_content)
 
             fc_parts = [
                 p for p in model_content.parts
                 if p.function_call and p.function_call.name
             ]
 
-            if not fc_parts:
+            if not fc_parts or final:
+                # 最後一輪若仍有 function call 就不寫入歷史，避免留下沒有回應的呼叫
+                if not fc_parts:
+                    contents.append(model_content)
                 final_text = "".join(
                     p.text for p in model_content.parts if p.text
-                )
+                ) or final_text
                 break
 
+            contents.append(model_content)
+
             tool_parts: list[types.Part] = []
             for fc_part in fc_parts:
                 fc = fc_part.function_call
@@ -354,12 +530,15 @@ class EcommerceAgent:
                 func_args = dict(fc.args)
 
                 print(f"[Tool] {func_name}({func_args})")
-                result_dict, image_bytes = _execute_tool(
-                    func_name, func_args, line_user_id
+                if func_name in _USER_SCOPED_TOOLS:
+                    user_scoped = True
+                result_dict, image_bytes, image_path = await offload(
+                    _state_store, _execute_tool, func_name, func_args, line_user_id
                 )
 
                 if image_bytes:
                     final_image = image_bytes
+                    final_image_path = image_path
 
                 multimodal_parts: list[types.FunctionResponsePart] = []
                 if image_bytes:
@@ -382,5 +561,8 @@ class EcommerceAgent:
 
             contents.append(types.Content(role="tool", parts=tool_parts))
 
-        self._save_history(line_user_id, contents)
-        return final_text, final_image
+        metrics.incr("agent_loops")
+        metrics.observe("agent_loop_seconds", time.monotonic() - started)
+        return _LoopResult(
+            contents, final_text, final_image, final_image_path, user_scoped
+        )
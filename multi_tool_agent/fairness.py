@@ -0,0 +1,173 @@
+# multi_tool_agent/fairness.py
+import time
+from collections import deque
+from typing import NamedTuple
+
+from multi_tool_agent import metrics
+from multi_tool_agent.state import MemoryStore, StateStore, offload
+
+_WINDOW_NAMESPACE = "fairness_window"
+_PENDING_NAMESPACE = "fairness_pending"
+
+# 訊息被擋下的原因
+THROTTLED_USER = "user"
+THROTTLED_GLOBAL = "global"
+
+
+class Admission(NamedTuple):
+    text: str | None
+    throttled: str | None
+
+
+class SlidingWindowLimiter:
+    """Allow at most limit hits per key within the last window_seconds.
+
+    Keeps a log of admitted timestamps per key; rejected hits are not logged,
+    so a throttled user regains capacity as soon as old hits age out.
+    """
+
+    def __init__(self, limit: int, window_seconds: float, clock=time.monotonic):
+        self._limit = limit
+        self._window = window_seconds
+        self._clock = clock
+        self._hits: dict[str, deque[float]] = {}
+
+    def allow(self, key: str) -> bool:
+        now = self._clock()
+        hits = self._hits.setdefault(key, deque())
+        while hits and hits[0] <= now - self._window:
+            hits.popleft()
+        if len(hits) >= self._limit:
+            return False
+        hits.append(now)
+        return True
+
+    def prune(self) -> None:
+        """清除已無有效紀錄的 key，避免記憶體隨用戶數成長。"""
+        cutoff = self._clock() - self._window
+        for key in [k for k, h in self._hits.items() if not h or h[-1] <= cutoff]:
+            del self._hits[key]
+
+
+class SharedWindowLimiter:
+    """Sliding-window counter limiter backed by a (shared) StateStore.
+
+    Approximates the sliding window from the current and previous fixed
+    window counters, weighting the previous one by how much of it still
+    overlaps the sliding window. Counters are updated atomically with
+    store.incr, so the limit holds across worker processes.
+    """
+
+    def __init__(
+        self, store: StateStore, limit: int, window_seconds: float, clock=time.time
+    ):
+        self._store = store
+        self._limit = limit
+        self._window = window_seconds
+        self._clock = clock
+
+    def allow(self, key: str) -> bool:
+        now = self._clock()
+        index, offset = divmod(now, self._window)
+        current_key = f"{key}:{int(index)}"
+        previous = self._store.get_counter(
+            _WINDOW_NAMESPACE, f"{key}:{int(index) - 1}"
+        )
+        current = self._store.incr(
+            _WINDOW_NAMESPACE, current_key, 1, ttl=2 * self._window
+        )
+        estimate = previous * (1 - offset / self._window) + current
+        if estimate > self._limit:
+            self._store.incr(_WINDOW_NAMESPACE, current_key, -1)
+            return False
+        return True
+
+    def prune(self) -> None:
+        """計數器由 store 的 TTL 自動過期，不需手動清除。"""
+
+
+class FairnessGate:
+    """Per-user sliding-window throttle plus a global in-flight cap.
+
+    admit() returns an Admission: the text to process, or None plus the
+    limit that held the message back (THROTTLED_USER / THROTTLED_GLOBAL).
+    Held-back messages are buffered (up to max_pending per user) and
+    merged into that user's next admitted message. Every admitted message
+    must be paired with release(). A limit of 0 disables that check.
+
+    With a shared store, the per-user window and pending buffer are shared
+    between workers; the in-flight cap always applies per worker process.
+    """
+
+    def __init__(
+        self,
+        per_user_limit: int = 5,
+        window_seconds: float = 60,
+        max_in_flight: int = 20,
+        max_pending: int = 3,
+        pending_ttl: float = 3600,
+        clock=time.monotonic,
+        store: StateStore | None = None,
+    ):
+        self._per_user: SlidingWindowLimiter | SharedWindowLimiter | None = None
+        if per_user_limit > 0:
+            if store is None:
+                self._per_user = SlidingWindowLimiter(
+                    per_user_limit, window_seconds, clock
+                )
+            else:
+                self._per_user = SharedWindowLimiter(
+                    store, per_user_limit, window_seconds
+                )
+        self._max_in_flight = max_in_flight
+        self._max_pending = max_pending
+        self._pending_ttl = pending_ttl
+        self._in_flight = 0
+        self._admitted = 0
+        self._store = store or MemoryStore(clock=clock)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def admit(self, user_id: str, text: str) -> Admission:
+        if self._max_in_flight and self._in_flight >= self._max_in_flight:
+            metrics.incr("fairness_throttled_global")
+            await self._hold(user_id, text)
+            return Admission(None, THROTTLED_GLOBAL)
+        # 先佔住名額再等待 store I/O，避免並行的 admit 超過上限
+        self._in_flight += 1
+        try:
+            allowed = not self._per_user or await offload(
+                self._store, self._per_user.allow, user_id
+            )
+            if allowed:
+                pending = await offload(
+                    self._store, self._store.list_pop_all, _PENDING_NAMESPACE, user_id
+                )
+        except BaseException:
+            # store 出錯時歸還名額，否則名額會永久流失
+            self._in_flight -= 1
+            raise
+        if not allowed:
+            self._in_flight -= 1
+            metrics.incr("fairness_throttled_user")
+            await self._hold(user_id, text)
+            return Admission(None, THROTTLED_USER)
+
+        self._admitted += 1
+        if self._per_user and self._admitted % 1000 == 0:
+            self._per_user.prune()
+        if pending:
+            metrics.incr("fairness_merged", len(pending))
+            return Admission("\n".join(pending + [text]), None)
+        return Admission(text, None)
+
+    def release(self) -> None:
+        self._in_flight -= 1
+
+    async def _hold(self, user_id: str, text: str) -> None:
+        await offload(
+            self._store, self._store.list_append, _PENDING_NAMESPACE, user_id,
+            text, self._max_pending, self._pending_ttl,
+        )
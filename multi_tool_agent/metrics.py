@@ -0,0 +1,29 @@
+# multi_tool_agent/metrics.py
+"""Process-local counters exported by the /metrics endpoint."""
+from collections import defaultdict
+
+_counters: dict[str, float] = defaultdict(float)
+
+
+def incr(name: str, value: float = 1) -> None:
+    """累加計數器。"""
+    _counters[name] += value
+
+
+def observe(name: str, value: float) -> None:
+    """記錄一筆觀測值（產生 _count、_sum、_max 三個計數器）。"""
+    _counters[f"{name}_count"] += 1
+    _counters[f"{name}_sum"] += value
+    _counters[f"{name}_max"] = max(_counters[f"{name}_max"], value)
+
+
+def get(name: str) -> float:
+    return _counters.get(name, 0)
+
+
+def snapshot() -> dict[str, float]:
+    return dict(_counters)
+
+
+def reset() -> None:
+    _counters.clear()
@@ -0,0 +1,210 @@
+# multi_tool_agent/rate_limiter.py
+import asyncio
+import heapq
+import itertools
+import random
+import time
+
+from google.genai import errors
+
+from multi_tool_agent import metrics
+
+# 優先權：數字越小越先處理。工具回應後的後續呼叫（follow-up）優先，
+# 讓已經在進行中的對話先完成，而不是被新進訊息插隊。
+PRIORITY_FOLLOW_UP = 0
+PRIORITY_FIRST_TURN = 1
+
+# 可重試的 HTTP 狀態碼（配額用盡 / 服務暫時無法使用）
+_RETRYABLE_CODES = {429, 500, 503}
+
+
+class RateLimitExceeded(Exception):
+    """排程佇列已滿，請求被拒絕。"""
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at rate_per_minute.
+
+    The balance may go negative (debt) so that usage measured after the fact,
+    like token counts, can be charged to the bucket.
+    """
+
+    def __init__(self, rate_per_minute: float, clock=time.monotonic):
+        self._rate = rate_per_minute / 60.0
+        self._capacity = float(rate_per_minute)
+        self._tokens = self._capacity
+        self._clock = clock
+        self._updated = clock()
+
+    @property
+    def capacity(self) -> float:
+        return self._capacity
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self._tokens = min(
+            self._capacity, self._tokens + (now - self._updated) * self._rate
+        )
+        self._updated = now
+
+    def delay_until(self, amount: float) -> float:
+        """Seconds until at least amount tokens are available (0 if now)."""
+        self._refill()
+        if self._tokens >= amount:
+            return 0.0
+        return (amount - self._tokens) / self._rate
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self._tokens -= amount
+
+
+def _is_retryable(exc: Exception) -> bool:
+    return isinstance(exc, errors.APIError) and exc.code in _RETRYABLE_CODES
+
+
+class GeminiScheduler:
+    """Quota-aware front for client.aio.models.generate_content.
+
+    Requests pass through a priority queue gated by RPM / TPM token buckets
+    (0 disables a limit). Each call is charged an estimated token cost up
+    front (the average of recent calls, starting at token_estimate) and
+    corrected once its real usage is known. Retryable API errors are retried
+    with full-jitter exponential backoff.
+
+    queue_depth counts every outstanding call: waiting for quota, running or
+    backing off. When it is deeper than fallback_queue_depth and a
+    fallback_model is set, new requests use the fallback model; when it
+    reaches max_queue, new requests are rejected with RateLimitExceeded.
+    """
+
+    def __init__(
+        self,
+        client,
+        rpm: int = 0,
+        tpm: int = 0,
+        max_queue: int = 100,
+        fallback_model: str | None = None,
+        fallback_queue_depth: int = 20,
+        max_retries: int = 3,
+        backoff_base: float = 1.0,
+        backoff_cap: float = 30.0,
+        token_estimate: int = 2000,
+    ):
+        self._client = client
+        self._rpm = TokenBucket(rpm) if rpm > 0 else None
+        self._tpm = TokenBucket(tpm) if tpm > 0 else None
+        self._max_queue = max_queue
+        self._fallback_model = fallback_model
+        self._fallback_queue_depth = fallback_queue_depth
+        self._max_retries = max_retries
+        self._backoff_base = backoff_base
+        self._backoff_cap = backoff_cap
+        self._token_estimate = float(token_estimate)
+        self._waiting: list[tuple[int, int]] = []
+        self._outstanding = 0
+        self._seq = itertools.count()
+        self._cond = asyncio.Condition()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._outstanding
+
+    async def generate_content(
+        self, *, model: str, priority: int = PRIORITY_FIRST_TURN, **kwargs
+    ):
+        """Schedule one generate_content call. kwargs are passed through."""
+        if self.queue_depth >= self._max_queue:
+            metrics.incr("gemini_rejected")
+            raise RateLimitExceeded(f"queue depth {self.queue_depth}")
+        if self._fallback_model and self.queue_depth >= self._fallback_queue_depth:
+            metrics.incr("gemini_fallback")
+            model = self._fallback_model
+
+        self._outstanding += 1
+        try:
+            for attempt in range(self._max_retries + 1):
+                estimate = await self._acquire(priority)
+                try:
+                    response = await self._client.aio.models.generate_content(
+                        model=model, **kwargs
+                    )
+                except Exception as e:
+                    # 失敗的呼叫不計 token，退回預扣的估計值
+                    await self._charge_tokens(estimate, 0)
+                    if attempt == self._max_retries or not _is_retryable(e):
+                        raise
+                    metrics.incr("gemini_retries")
+                    delay = random.uniform(
+                        0, min(self._backoff_cap, self._backoff_base * 2 ** attempt)
+                    )
+                    print(f"[RateLimit] {e}; retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    continue
+
+                await self._record_usage(response, estimate)
+                return response
+        finally:
+            self._outstanding -= 1
+
+    def _estimate(self) -> float:
+        """預估單次呼叫的 token 數（不超過 bucket 容量，否則永遠等不到）。"""
+        return min(self._token_estimate, self._tpm.capacity) if self._tpm else 0.0
+
+    def _delay(self) -> float:
+        delay = 0.0
+        if self._rpm:
+            delay = max(delay, self._rpm.delay_until(1))
+        if self._tpm:
+            # 呼叫前先預扣估計用量，避免餘額為正時大量並行呼叫同時放行
+            delay = max(delay, self._tpm.delay_until(self._estimate()))
+        return delay
+
+    async def _acquire(self, priority: int) -> float:
+        """Wait for quota; returns the token estimate charged for the call."""
+        entry = (priority, next(self._seq))
+        started = time.monotonic()
+        async with self._cond:
+            heapq.heappush(self._waiting, entry)
+            self._cond.notify_all()
+            try:
+                while True:
+                    timeout = None
+                    if self._waiting[0] == entry:
+                        timeout = self._delay()
+                        if timeout <= 0:
+                            break
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+            if self._rpm:
+                self._rpm.consume(1)
+            estimate = self._estimate()
+            if self._tpm:
+                self._tpm.consume(estimate)
+        metrics.observe("gemini_queue_wait_seconds", time.monotonic() - started)
+        return estimate
+
+    async def _charge_tokens(self, estimate: float, actual: float) -> None:
+        """Replace the pre-charged estimate with the actual usage."""
+        if not self._tpm or actual == estimate:
+            return
+        self._tpm.consume(actual - estimate)
+        # 退回的額度可能讓排在前面的請求提早放行
+        async with self._cond:
+            self._cond.notify_all()
+
+    async def _record_usage(self, response, estimate: float) -> None:
+        usage = getattr(response, "usage_metadata", None)
+        total = getattr(usage, "total_token_count", None)
+        if not isinstance(total, int):
+            return  # 用量不明時保留預扣的估計值
+        metrics.incr("gemini_tokens", total)
+        await self._charge_tokens(estimate, total)
+        # 指數移動平均，讓估計值跟上實際對話長度
+        self._token_estimate += 0.2 * (total - self._token_estimate)
@@ -0,0 +1,402 @@
+# multi_tool_agent/state.py
+"""Pluggable key-value stores for state shared between uvicorn workers.
+
+MemoryStore keeps state in the current process (single worker only).
+SqliteStore shares state between worker processes on one host through a
+SQLite file; RedisStore shares it between hosts. Values in the shared
+stores are pickled, so the store itself must be trusted.
+
+Shared stores do blocking I/O; async code calls them through offload() so
+the event loop never waits on a SQLite lock or a Redis round-trip.
+"""
+import asyncio
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any
+
+
+class StateStore(ABC):
+    """Namespaced key-value store with optional per-key TTL (seconds)."""
+
+    # True 代表多個 worker process 看得到同一份資料
+    shared = False
+
+    @abstractmethod
+    def get(self, namespace: str, key: str) -> Any | None:
+        ...
+
+    @abstractmethod
+    def set(
+        self, namespace: str, key: str, value: Any, ttl: float | None = None
+    ) -> None:
+        ...
+
+    @abstractmethod
+    def add(
+        self, namespace: str, key: str, value: Any, ttl: float | None = None
+    ) -> bool:
+        """Set key only if it is absent. Returns True if it was set."""
+
+    @abstractmethod
+    def delete(self, namespace: str, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def incr(
+        self, namespace: str, key: str, amount: int = 1, ttl: float | None = None
+    ) -> int:
+        """Atomically add amount to an integer counter and return the result.
+
+        ttl only applies when the counter is created.
+        """
+
+    @abstractmethod
+    def get_counter(self, namespace: str, key: str) -> int:
+        """Read a counter written by incr without creating it (0 if absent)."""
+
+    @abstractmethod
+    def list_append(
+        self, namespace: str, key: str, item: Any, max_len: int,
+        ttl: float | None = None,
+    ) -> None:
+        """Atomically append item to a list, keeping its last max_len items."""
+
+    @abstractmethod
+    def list_pop_all(self, namespace: str, key: str) -> list:
+        """Atomically remove a list and return its items ([] if absent)."""
+
+
+class MemoryStore(StateStore):
+    """In-process store. Values are kept as-is (not copied or pickled).
+
+    With max_entries set, the oldest written keys are evicted first.
+    """
+
+    def __init__(self, max_entries: int | None = None, clock=time.monotonic):
+        self._max_entries = max_entries
+        self._clock = clock
+        # (namespace, key) → (value, expires_at | None)，依寫入順序排列
+        self._data: OrderedDict[tuple[str, str], tuple[Any, float | None]] = OrderedDict()
+        self._writes = 0
+
+    def _live(self, k: tuple[str, str]) -> tuple[Any, float | None] | None:
+        entry = self._data.get(k)
+        if entry is not None and entry[1] is not None and entry[1] <= self._clock():
+            del self._data[k]
+            return None
+        return entry
+
+    def _write(self, k: tuple[str, str], value: Any, expires_at: float | None) -> None:
+        self._data.pop(k, None)
+        self._data[k] = (value, expires_at)
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            self._sweep()
+        if self._max_entries is not None:
+            while len(self._data) > self._max_entries:
+                self._data.popitem(last=False)
+
+    def _sweep(self) -> None:
+        now = self._clock()
+        for k in [k for k, (_, exp) in self._data.items() if exp is not None and exp <= now]:
+            del self._data[k]
+
+    def _expires_at(self, ttl: float | None) -> float | None:
+        return None if ttl is None else self._clock() + ttl
+
+    def get(self, namespace, key):
+        entry = self._live((namespace, key))
+        return entry[0] if entry else None
+
+    def set(self, namespace, key, value, ttl=None):
+        self._write((namespace, key), value, self._expires_at(ttl))
+
+    def add(self, namespace, key, value, ttl=None):
+        if self._live((namespace, key)) is not None:
+            return False
+        self._write((namespace, key), value, self._expires_at(ttl))
+        return True
+
+    def delete(self, namespace, key):
+        self._data.pop((namespace, key), None)
+
+    def incr(self, namespace, key, amount=1, ttl=None):
+        k = (namespace, key)
+        entry = self._live(k)
+        if entry is None:
+            value, expires_at = amount, self._expires_at(ttl)
+        else:
+            value, expires_at = entry[0] + amount, entry[1]
+        self._write(k, value, expires_at)
+        return value
+
+    def get_counter(self, namespace, key):
+        return self.get(namespace, key) or 0
+
+    def list_append(self, namespace, key, item, max_len, ttl=None):
+        items = (self.get(namespace, key) or []) + [item]
+        self.set(namespace, key, items[-max_len:], ttl=ttl)
+
+    def list_pop_all(self, namespace, key):
+        items = self.get(namespace, key) or []
+        self.delete(namespace, key)
+        return items
+
+
+class SqliteStore(StateStore):
+    """Single-host store shared by worker processes through a SQLite file."""
+
+    shared = True
+
+    def __init__(self, path: str):
+        self._path = path
+        self._local = threading.local()
+        self._writes = 0
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL,"
+                " value BLOB NOT NULL, expires_at REAL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # 每個 thread 各自一條連線；fork 之後不能沿用父 process 的連線
+        local = self._local
+        if getattr(local, "conn", None) is None or local.pid != os.getpid():
+            local.conn = sqlite3.connect(
+                self._path, timeout=30, isolation_level=None
+            )
+            local.conn.execute("PRAGMA journal_mode=WAL")
+            local.conn.execute("PRAGMA synchronous=NORMAL")
+            local.pid = os.getpid()
+        return local.conn
+
+    @contextmanager
+    def _transaction(self):
+        """BEGIN IMMEDIATE 取得寫入鎖，讓讀取-修改-寫入在多 process 間保持原子性。"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _expires_at(ttl: float | None) -> float | None:
+        return None if ttl is None else time.time() + ttl
+
+    @staticmethod
+    def _select(conn: sqlite3.Connection, namespace: str, key: str):
+        return conn.execute(
+            "SELECT value, expires_at FROM kv WHERE namespace = ? AND key = ?"
+            " AND (expires_at IS NULL OR expires_at > ?)",
+            (namespace, key, time.time()),
+        ).fetchone()
+
+    def get(self, namespace, key):
+        row = self._select(self._connect(), namespace, key)
+        return pickle.loads(row[0]) if row else None
+
+    def set(self, namespace, key, value, ttl=None):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO kv VALUES (?, ?, ?, ?)",
+            (namespace, key, pickle.dumps(value), self._expires_at(ttl)),
+        )
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            self.purge_expired()
+
+    def add(self, namespace, key, value, ttl=None):
+        with self._transaction() as conn:
+            conn.execute(
+                "DELETE FROM kv WHERE namespace = ? AND key = ? AND expires_at <= ?",
+                (namespace, key, time.time()),
+            )
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO kv VALUES (?, ?, ?, ?)",
+                (namespace, key, pickle.dumps(value), self._expires_at(ttl)),
+            )
+        return cur.rowcount == 1
+
+    def delete(self, namespace, key):
+        self._connect().execute(
+            "DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key)
+        )
+
+    def incr(self, namespace, key, amount=1, ttl=None):
+        with self._transaction() as conn:
+            row = self._select(conn, namespace, key)
+            if row is None:
+                value, expires_at = amount, self._expires_at(ttl)
+            else:
+                value, expires_at = pickle.loads(row[0]) + amount, row[1]
+            conn.execute(
+                "INSERT OR REPLACE INTO kv VALUES (?, ?, ?, ?)",
+                (namespace, key, pickle.dumps(value), expires_at),
+            )
+        return value
+
+    def get_counter(self, namespace, key):
+        return self.get(namespace, key) or 0
+
+    def list_append(self, namespace, key, item, max_len, ttl=None):
+        with self._transaction() as conn:
+            row = self._select(conn, namespace, key)
+            items = (pickle.loads(row[0]) if row else []) + [item]
+            conn.execute(
+                "INSERT OR REPLACE INTO kv VALUES (?, ?, ?, ?)",
+                (namespace, key, pickle.dumps(items[-max_len:]), self._expires_at(ttl)),
+            )
+
+    def list_pop_all(self, namespace, key):
+        with self._transaction() as conn:
+            row = self._select(conn, namespace, key)
+            conn.execute(
+                "DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key)
+            )
+        return pickle.loads(row[0]) if row else []
+
+    def purge_expired(self) -> None:
+        self._connect().execute(
+            "DELETE FROM kv WHERE expires_at <= ?", (time.time(),)
+        )
+
+
+class RedisStore(StateStore):
+    """Multi-host store backed by Redis 7+ (requires the optional redis package)."""
+
+    shared = True
+
+    def __init__(self, url: str, prefix: str = "linebot:"):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError(
+                "RedisStore requires the redis package: pip install -r requirements-redis.txt"
+            ) from e
+        self._redis = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def _key(self, namespace: str, key: str) -> str:
+        return f"{self._prefix}{namespace}:{key}"
+
+    @staticmethod
+    def _px(ttl: float | None) -> int | None:
+        return None if ttl is None else max(1, int(ttl * 1000))
+
+    @staticmethod
+    def _decode(raw: bytes) -> Any:
+        # pickle（protocol 2 以上）以 0x80 開頭；其餘是 incr 寫入的原生整數
+        if raw[:1] == b"\x80":
+            return pickle.loads(raw)
+        return int(raw)
+
+    def get(self, namespace, key):
+        raw = self._redis.get(self._key(namespace, key))
+        return self._decode(raw) if raw is not None else None
+
+    def set(self, namespace, key, value, ttl=None):
+        self._redis.set(self._key(namespace, key), pickle.dumps(value), px=self._px(ttl))
+
+    def add(self, namespace, key, value, ttl=None):
+        return bool(self._redis.set(
+            self._key(namespace, key), pickle.dumps(value), px=self._px(ttl), nx=True
+        ))
+
+    def delete(self, namespace, key):
+        self._redis.delete(self._key(namespace, key))
+
+    def incr(self, namespace, key, amount=1, ttl=None):
+        # 計數器以 Redis 原生整數儲存（不經 pickle）。INCRBY 與 PEXPIRE NX 放在
+        # 同一個 MULTI/EXEC，只在計數器還沒有 TTL 時設定（需 Redis 7 以上）
+        k = self._key(namespace, key)
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.incrby(k, amount)
+        if ttl is not None:
+            pipe.pexpire(k, self._px(ttl), nx=True)
+        return int(pipe.execute()[0])
+
+    def get_counter(self, namespace, key):
+        raw = self._redis.get(self._key(namespace, key))
+        return int(raw) if raw is not None else 0
+
+    def list_append(self, namespace, key, item, max_len, ttl=None):
+        # 以 Redis list 儲存（每個元素各自 pickle），MULTI/EXEC 保持原子性
+        k = self._key(namespace, key)
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.rpush(k, pickle.dumps(item))
+        pipe.ltrim(k, -max_len, -1)
+        if ttl is not None:
+            pipe.pexpire(k, self._px(ttl))
+        pipe.execute()
+
+    def list_pop_all(self, namespace, key):
+        k = self._key(namespace, key)
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.lrange(k, 0, -1)
+        pipe.delete(k)
+        raw_items, _ = pipe.execute()
+        return [pickle.loads(raw) for raw in raw_items]
+
+
+class StoreMapping:
+    """dict-style view over one namespace of a StateStore."""
+
+    def __init__(self, store: StateStore, namespace: str, ttl: float | None = None):
+        self._store = store
+        self._namespace = namespace
+        self._ttl = ttl
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self._store.get(self._namespace, key)
+        return default if value is None else value
+
+    def __getitem__(self, key: str) -> Any:
+        value = self._store.get(self._namespace, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._store.set(self._namespace, key, value, ttl=self._ttl)
+
+    def __delitem__(self, key: str) -> None:
+        self._store.delete(self._namespace, key)
+
+    def __contains__(self, key: str) -> bool:
+        return self._store.get(self._namespace, key) is not None
+
+
+async def offload(store: StateStore, fn, *args):
+    """Run fn(*args) in a worker thread when it touches a shared store.
+
+    MemoryStore calls stay on the event loop: they do no I/O and the store
+    is not thread-safe.
+    """
+    if store.shared:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+def create_store(
+    backend: str, sqlite_path: str | None = None, redis_url: str | None = None
+) -> StateStore:
+    """依 STATE_BACKEND 設定建立 store：memory、sqlite 或 redis。"""
+    if backend == "memory":
+        return MemoryStore()
+    if backend == "sqlite":
+        return SqliteStore(sqlite_path or "linebot-state.db")
+    if backend == "redis":
+        if not redis_url:
+            raise ValueError("redis backend requires a URL")
+        return RedisStore(redis_url)
+    raise ValueError(f"unknown state backend: {backend}")
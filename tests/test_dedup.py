@@ -0,0 +1,63 @@
+from multi_tool_agent.dedup import COMPLETED, IN_PROGRESS, EventDeduplicator
+from multi_tool_agent.state import SqliteStore
+
+
+def test_first_delivery_is_claimed_and_redelivery_rejected():
+    dedup = EventDeduplicator()
+    assert dedup.begin("evt-1")
+    assert dedup.state("evt-1") == IN_PROGRESS
+    assert not dedup.begin("evt-1")
+
+
+def test_completed_event_is_still_rejected():
+    dedup = EventDeduplicator()
+    dedup.begin("evt-1")
+    dedup.complete("evt-1")
+    assert dedup.state("evt-1") == COMPLETED
+    assert not dedup.begin("evt-1")
+
+
+def test_forgotten_event_can_be_processed_again():
+    dedup = EventDeduplicator()
+    dedup.begin("evt-1")
+    dedup.forget("evt-1")
+    assert dedup.begin("evt-1")
+
+
+def test_entries_expire_after_ttl(clock):
+    dedup = EventDeduplicator(ttl_seconds=60, clock=clock)
+    dedup.begin("evt-1")
+    dedup.complete("evt-1")
+    clock.now = 61
+    assert dedup.state("evt-1") is None
+    assert dedup.begin("evt-1")
+
+
+def test_oldest_entries_evicted_beyond_max_entries():
+    dedup = EventDeduplicator(max_entries=2)
+    for event_id in ["a", "b", "c"]:
+        dedup.begin(event_id)
+    assert dedup.state("a") is None
+    assert dedup.state("b") == IN_PROGRESS
+    assert dedup.state("c") == IN_PROGRESS
+
+
+def test_shared_store_dedups_across_workers(tmp_path):
+    path = str(tmp_path / "state.db")
+    worker_a = EventDeduplicator(store=SqliteStore(path))
+    worker_b = EventDeduplicator(store=SqliteStore(path))
+    assert worker_a.begin("evt-1")
+    assert not worker_b.begin("evt-1")
+    worker_a.complete("evt-1")
+    assert worker_b.state("evt-1") == COMPLETED
+
+
+def test_in_progress_lease_expires_but_completion_lasts(clock):
+    dedup = EventDeduplicator(ttl_seconds=600, lease_seconds=60, clock=clock)
+    dedup.begin("crashed")
+    dedup.begin("done")
+    dedup.complete("done")
+    clock.now = 61
+    assert dedup.begin("crashed")  # abandoned claim released
+    assert dedup.state("done") == COMPLETED
+    assert not dedup.begin("done")
@@ -95,6 +95,7 @@ class TestGetProductDetails:
         result = get_product_details(product_id="P999")
         assert result["status"] == "error"
 import asyncio
+import time
 from unittest.mock import AsyncMock, MagicMock, patch
 from multi_tool_agent.ecommerce_agent import EcommerceAgent
 from google.genai import types
@@ -185,3 +186,278 @@ async def test_agent_history_persists_across_messages():
         # Second call should include history (more contents in call)
         second_call_contents = mock_client.aio.models.generate_content.call_args_list[1][1]["contents"]
         assert len(second_call_contents) > 1  # has history
+
+
+@pytest.mark.asyncio
+async def test_agent_coalesces_concurrent_identical_first_turn():
+    """Concurrent identical first-turn queries share one Gemini call."""
+    with patch("multi_tool_agent.ecommerce_agent.genai.Client") as MockClient:
+        mock_client = MagicMock()
+        MockClient.return_value = mock_client
+        release = asyncio.Event()
+
+        async def slow_generate(**kwargs):
+            await release.wait()
+            return make_text_response("有的！")
+
+        mock_client.aio.models.generate_content = AsyncMock(side_effect=slow_generate)
+
+        agent = EcommerceAgent(api_key="fake-key")
+        tasks = [
+            asyncio.ensure_future(agent.process_message(" 有外套嗎 ", f"user_sf_{i}"))
+            for i in range(5)
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*tasks)
+
+        assert all(text == "有的！" for text, _ in results)
+        assert mock_client.aio.models.generate_content.call_count == 1
+        # Every waiter still gets its own history
+        assert all(agent._get_history(f"user_sf_{i}") for i in range(5))
+
+
+@pytest.mark.asyncio
+async def test_agent_does_not_share_user_scoped_results():
+    """Waiters re-run the loop when the shared run read user-scoped data."""
+    with patch("multi_tool_agent.ecommerce_agent.genai.Client") as MockClient, \
+            patch("multi_tool_agent.ecommerce_agent.generate_product_image",
+                  return_value=b"\xff\xd8"):
+        mock_client = MagicMock()
+        MockClient.return_value = mock_client
+        release = asyncio.Event()
+        responses = iter([
+            make_function_call_response("get_order_history", {"time_range": "all"}),
+            make_text_response("您的訂單"),
+            make_text_response("您的訂單"),
+        ])
+
+        async def slow_generate(**kwargs):
+            await release.wait()
+            return next(responses)
+
+        mock_client.aio.models.generate_content = AsyncMock(side_effect=slow_generate)
+
+        agent = EcommerceAgent(api_key="fake-key")
+        first = asyncio.ensure_future(agent.process_message("我買過什麼", "user_sf_a"))
+        second = asyncio.ensure_future(agent.process_message("我買過什麼", "user_sf_b"))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, second)
+
+        assert mock_client.aio.models.generate_content.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_agent_user_scoped_rerun_keeps_message_budget():
+    """A waiter's re-run only gets what is left of its own latency budget."""
+    with patch("multi_tool_agent.ecommerce_agent.genai.Client") as MockClient, \
+            patch("multi_tool_agent.ecommerce_agent.generate_product_image",
+                  return_value=b"\xff\xd8"):
+        mock_client = MagicMock()
+        MockClient.return_value = mock_client
+
+        async def slow_generate(**kwargs):
+            await asyncio.sleep(0.2)
+            if kwargs["contents"][-1].role == "tool":
+                return make_text_response("您的訂單")
+            return make_function_call_response(
+                "get_order_history", {"time_range": "all"}
+            )
+
+        mock_client.aio.models.generate_content = AsyncMock(side_effect=slow_generate)
+
+        agent = EcommerceAgent(
+            api_key="fake-key", latency_budget=0.5, final_answer_reserve=0.05
+        )
+        started = time.monotonic()
+        first = asyncio.ensure_future(agent.process_message("我買過什麼", "user_dl_a"))
+        second = asyncio.ensure_future(agent.process_message("我買過什麼", "user_dl_b"))
+        (first_text, _), _ = await asyncio.gather(first, second)
+        elapsed = time.monotonic() - started
+
+        assert first_text == "您的訂單"
+        # 領頭的 loop 約 0.4 秒；若重跑重新計時，總共會花約 0.8 秒
+        assert elapsed < 0.65
+
+
+@pytest.mark.asyncio
+async def test_agent_coalesced_error_reaches_all_waiters():
+    """An error in the shared call is raised to every waiter and not cached."""
+    with patch("multi_tool_agent.ecommerce_agent.genai.Client") as MockClient:
+        mock_client = MagicMock()
+        MockClient.return_value = mock_client
+        release = asyncio.Event()
+
+        async def failing_generate(**kwargs):
+            await release.wait()
+            raise RuntimeError("quota exceeded")
+
+        mock_client.aio.models.generate_content = AsyncMock(side_effect=failing_generate)
+
+        agent = EcommerceAgent(api_key="fake-key")
+        tasks = [
+            asyncio.ensure_future(agent.process_message("你好", f"user_err_{i}"))
+            for i in range(3)
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert mock_client.aio.models.generate_content.call_count == 1
+
+        mock_client.aio.models.generate_content = AsyncMock(
+            return_value=make_text_response("您好")
+        )
+        text, _ = await agent.process_message("你好", "user_err_0")
+        assert text == "您好"
+
+
+@pytest.mark.asyncio
+async def test_agent_reply_includes_product_image_path():
+    """reply() reports the file behind the product image."""
+    with patch("multi_tool_agent.ecommerce_agent.genai.Client") as MockClient:
+        mock_client = MagicMock()
+        MockClient.return_value = mock_client
+        mock_client.aio.models.generate_content = AsyncMock(side_effect=[
+            make_function_call_response("get_product_details", {"product_id": "P003"}),
+            make_text_response("這是深藍色牛仔外套"),
+        ])
+
+        agent = EcommerceAgent(api_key="fake-key")
+        reply = await agent.reply("P003 是什麼", "user_test_path")
+
+        assert reply.image_path == PRODUCTS_DB["P003"]["image_path"]
+        assert reply.image == generate_product_image(PRODUCTS_DB["P003"])
+
+
+def _tool_config(call):
+    return call.kwargs["config"].tool_config
+
+
+@pytest.mark.asyncio
+async def test_agent_disables_tools_on_last_iteration():
+    """The last allowed round runs without tools instead of giving up."""
+    from multi_tool_agent import metrics
+    metrics.reset()
+    with patch("multi_tool_agent.ecommerce_agent.genai.Client") as MockClient:
+        mock_client = MagicMock()
+        MockClient.return_value = mock_client
+        mock_client.aio.models.generate_content = AsyncMock(side_effect=[
+            make_function_call_response("get_product_details", {"product_id": "P003"}),
+            make_text_response("根據查詢結果，這是深藍色牛仔外套"),
+        ])
+
+        agent = EcommerceAgent(api_key="fake-key", max_iterations=2)
+        text, _ = await agent.process_message("P003", "user_test_last")
+
+        calls = mock_client.aio.models.generate_content.call_args_list
+        assert _tool_config(calls[0]) is None
+        assert _tool_config(calls[1]).function_calling_config.mode == "NONE"
+        assert text == "根據查詢結果，這是深藍色牛仔外套"
+        assert metrics.get("agent_forced_answer_iterations") == 1
+
+
+@pytest.mark.asyncio
+async def test_agent_slow_tool_round_falls_back_to_final_answer():
+    """A tool round that eats into the reserve is cut off and answered without tools."""
+    from multi_tool_agent import metrics
+    metrics.reset()
+    with patch("multi_tool_agent.ecommerce_agent.genai.Client") as MockClient:
+        mock_client = MagicMock()
+        MockClient.return_value = mock_client
+
+        async def generate(**kwargs):
+            if kwargs["config"].tool_config is None:
+                await asyncio.sleep(10)
+            return make_text_response("先回答您目前的資訊")
+
+        mock_client.aio.models.generate_content = AsyncMock(side_effect=generate)
+
+        agent = EcommerceAgent(
+            api_key="fake-key", latency_budget=0.3, final_answer_reserve=0.2
+        )
+        text, _ = await agent.process_message("有外套嗎", "user_test_slow")
+
+        assert text == "先回答您目前的資訊"
+        assert mock_client.aio.models.generate_content.call_count == 2
+        assert metrics.get("agent_iteration_timeout") == 1
+        assert metrics.get("agent_forced_answer_budget") == 1
+
+
+@pytest.mark.asyncio
+async def test_agent_deadline_exceeded_returns_apology():
+    """When even the final round misses the deadline the default reply is used."""
+    from multi_tool_agent import metrics
+    metrics.reset()
+    with patch("multi_tool_agent.ecommerce_agent.genai.Client") as MockClient:
+        mock_client = MagicMock()
+        MockClient.return_value = mock_client
+
+        async def hang(**kwargs):
+            await asyncio.sleep(10)
+
+        mock_client.aio.models.generate_content = AsyncMock(side_effect=hang)
+
+        agent = EcommerceAgent(
+            api_key="fake-key", latency_budget=0.2, final_answer_reserve=0.1
+        )
+        text, image = await agent.process_message("你好", "user_test_deadline")
+
+        assert "抱歉" in text
+        assert image is None
+        assert metrics.get("agent_deadline_exceeded") == 1
+
+
+@pytest.mark.asyncio
+async def test_agent_shared_history_drops_images_and_expires(tmp_path):
+    """Histories in a shared store keep tool results but not image bytes."""
+    from multi_tool_agent.state import SqliteStore
+    store = SqliteStore(str(tmp_path / "state.db"))
+    with patch("multi_tool_agent.ecommerce_agent.genai.Client") as MockClient:
+        mock_client = MagicMock()
+        MockClient.return_value = mock_client
+        mock_client.aio.models.generate_content = AsyncMock(side_effect=[
+            make_function_call_response("get_product_details", {"product_id": "P003"}),
+            make_text_response("這是深藍色牛仔外套"),
+        ])
+
+        agent = EcommerceAgent(api_key="fake-key", store=store, history_ttl=60)
+        _, image = await agent.process_message("P003", "user_shared_hist")
+
+        assert image is not None
+        history = store.get("history", "user_shared_hist")
+        responses = [
+            p.function_response for c in history for p in c.parts if p.function_response
+        ]
+        assert responses and all(r.parts is None for r in responses)
+        assert responses[0].response["product"]["id"] == "P003"
+        (expires_at,) = store._connect().execute(
+            "SELECT expires_at FROM kv WHERE namespace = 'history'"
+        ).fetchone()
+        assert expires_at is not None
+
+
+def test_agent_rejects_reserve_not_below_budget():
+    with patch("multi_tool_agent.ecommerce_agent.genai.Client"):
+        with pytest.raises(ValueError):
+            EcommerceAgent(api_key="fake-key", latency_budget=5, final_answer_reserve=8)
+
+
+@pytest.mark.asyncio
+async def test_agent_counts_forced_answer_on_first_iteration():
+    """A single-round loop answering without tools is still counted."""
+    from multi_tool_agent import metrics
+    metrics.reset()
+    with patch("multi_tool_agent.ecommerce_agent.genai.Client") as MockClient:
+        mock_client = MagicMock()
+        MockClient.return_value = mock_client
+        mock_client.aio.models.generate_content = AsyncMock(
+            return_value=make_text_response("您好")
+        )
+
+        agent = EcommerceAgent(api_key="fake-key", max_iterations=1)
+        await agent.process_message("你好", "user_test_first_forced")
+
+        assert metrics.get("agent_forced_answer_iterations") == 1
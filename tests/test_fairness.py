@@ -0,0 +1,154 @@
+import pytest
+
+from multi_tool_agent.fairness import (
+    THROTTLED_GLOBAL,
+    THROTTLED_USER,
+    FairnessGate,
+    SharedWindowLimiter,
+    SlidingWindowLimiter,
+)
+from multi_tool_agent.state import MemoryStore, SqliteStore
+
+
+class TestSlidingWindowLimiter:
+    def test_allows_up_to_limit_within_window(self, clock):
+        limiter = SlidingWindowLimiter(3, 10, clock)
+        assert [limiter.allow("u") for _ in range(4)] == [True, True, True, False]
+
+    def test_capacity_returns_as_hits_age_out(self, clock):
+        limiter = SlidingWindowLimiter(2, 10, clock)
+        limiter.allow("u")
+        clock.now = 5
+        limiter.allow("u")
+        assert not limiter.allow("u")
+        clock.now = 10
+        assert limiter.allow("u")
+        assert not limiter.allow("u")
+
+    def test_keys_are_independent(self, clock):
+        limiter = SlidingWindowLimiter(1, 10, clock)
+        assert limiter.allow("a")
+        assert limiter.allow("b")
+        assert not limiter.allow("a")
+
+    def test_prune_drops_idle_keys(self, clock):
+        limiter = SlidingWindowLimiter(1, 10, clock)
+        limiter.allow("a")
+        clock.now = 20
+        limiter.prune()
+        assert limiter._hits == {}
+
+
+class TestFairnessGate:
+    @pytest.mark.asyncio
+    async def test_throttled_messages_merge_into_next(self, clock):
+        gate = FairnessGate(per_user_limit=1, window_seconds=10, clock=clock)
+        assert (await gate.admit("u", "第一則")).text == "第一則"
+        gate.release()
+        assert (await gate.admit("u", "第二則")).text is None
+        clock.now = 10
+        assert (await gate.admit("u", "第三則")).text == "第二則\n第三則"
+
+    @pytest.mark.asyncio
+    async def test_pending_buffer_is_bounded(self, clock):
+        gate = FairnessGate(per_user_limit=1, window_seconds=10, max_pending=2, clock=clock)
+        assert (await gate.admit("u", "a")).text == "a"
+        gate.release()
+        for text in ["b", "c", "d"]:
+            assert (await gate.admit("u", text)).text is None
+        clock.now = 10
+        assert (await gate.admit("u", "e")).text == "c\nd\ne"
+
+    @pytest.mark.asyncio
+    async def test_abusive_user_does_not_starve_others(self):
+        gate = FairnessGate(per_user_limit=5, window_seconds=60, max_in_flight=0)
+        abuser_admitted = 0
+        for _ in range(1000):
+            abuser_admitted += (await gate.admit("abuser", "spam")).text is not None
+        others_admitted = 0
+        for i in range(50):
+            others_admitted += (await gate.admit(f"user{i}", "hi")).text is not None
+        assert abuser_admitted == 5
+        assert others_admitted == 50
+
+    @pytest.mark.asyncio
+    async def test_global_in_flight_cap(self):
+        gate = FairnessGate(per_user_limit=0, max_in_flight=2)
+        assert (await gate.admit("a", "x")).text == "x"
+        assert (await gate.admit("b", "x")).text == "x"
+        assert (await gate.admit("c", "x")).text is None
+        gate.release()
+        assert (await gate.admit("c", "y")).text == "x\ny"
+        assert gate.in_flight == 2
+
+    @pytest.mark.asyncio
+    async def test_reports_which_limit_held_the_message(self):
+        gate = FairnessGate(per_user_limit=1, max_in_flight=1)
+        assert (await gate.admit("a", "x")).throttled is None
+        assert (await gate.admit("b", "x")).throttled == THROTTLED_GLOBAL
+        gate.release()
+        assert (await gate.admit("a", "y")).throttled == THROTTLED_USER
+
+    @pytest.mark.asyncio
+    async def test_store_error_gives_back_in_flight_slot(self):
+        class FlakyStore(MemoryStore):
+            failing = True
+
+            def incr(self, *args, **kwargs):
+                if self.failing:
+                    raise OSError("store unavailable")
+                return super().incr(*args, **kwargs)
+
+        store = FlakyStore()
+        gate = FairnessGate(per_user_limit=5, max_in_flight=3, store=store)
+        for _ in range(3):
+            with pytest.raises(OSError):
+                await gate.admit("u", "x")
+        assert gate.in_flight == 0
+        store.failing = False
+        assert (await gate.admit("u", "y")).text == "y"
+
+    @pytest.mark.asyncio
+    async def test_shared_pending_merged_by_only_one_worker(self, tmp_path):
+        import asyncio
+        path = str(tmp_path / "state.db")
+        workers = [
+            FairnessGate(per_user_limit=0, store=SqliteStore(path)) for _ in range(4)
+        ]
+        for i in range(3):
+            await workers[i]._hold("u", f"held{i}")
+
+        admissions = await asyncio.gather(*(
+            gate.admit("u", f"next{i}") for i, gate in enumerate(workers)
+        ))
+        merged = [a.text for a in admissions if a.text.startswith("held")]
+        assert merged == ["held0\nheld1\nheld2\n" + merged[0].rsplit("\n", 1)[1]]
+
+
+class TestSharedWindowLimiter:
+    def test_limit_shared_between_instances(self, clock, tmp_path):
+        path = str(tmp_path / "state.db")
+        worker_a = SharedWindowLimiter(SqliteStore(path), 3, 60, clock)
+        worker_b = SharedWindowLimiter(SqliteStore(path), 3, 60, clock)
+        results = [w.allow("u") for w in (worker_a, worker_b, worker_a, worker_b)]
+        assert results == [True, True, True, False]
+
+    def test_previous_window_weighs_less_over_time(self, clock, tmp_path):
+        limiter = SharedWindowLimiter(SqliteStore(str(tmp_path / "s.db")), 2, 60, clock)
+        assert limiter.allow("u") and limiter.allow("u")
+        clock.now = 60  # previous window still fully counted
+        assert not limiter.allow("u")
+        clock.now = 90  # half of it has slid out
+        assert limiter.allow("u")
+        assert not limiter.allow("u")
+
+    def test_leaves_no_counters_without_expiry(self, clock, tmp_path):
+        store = SqliteStore(str(tmp_path / "state.db"))
+        limiter = SharedWindowLimiter(store, 5, 10, clock)
+        for i in range(10):
+            clock.now = 15 + i * 10
+            limiter.allow("u")
+        rows = store._connect().execute(
+            "SELECT key FROM kv WHERE expires_at IS NULL"
+        ).fetchall()
+        assert rows == []
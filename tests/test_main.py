@@ -1,4 +1,8 @@
 # tests/test_main.py
+import os
+import subprocess
+import sys
+
 import pytest
 import uuid
 from unittest.mock import patch, MagicMock, AsyncMock
@@ -54,3 +58,181 @@ def test_image_endpoint_returns_correct_bytes(app_client):
     main_module.image_cache[test_id] = expected
     response = client.get(f"/images/{test_id}")
     assert response.content == expected
+
+
+def test_metrics_endpoint_returns_counters(app_client):
+    client, _ = app_client
+    from multi_tool_agent import metrics
+    metrics.incr("test_counter")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.json()["test_counter"] >= 1
+
+
+def make_text_event(text: str, user_id: str = "U_test", event_id: str | None = None):
+    from linebot.models import MessageEvent
+    return MessageEvent.new_from_json_dict({
+        "type": "message",
+        "mode": "active",
+        "timestamp": 0,
+        "webhookEventId": event_id or str(uuid.uuid4()),
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": "reply-token",
+        "source": {"type": "user", "userId": user_id},
+        "message": {"id": "1", "type": "text", "text": text},
+    })
+
+
+@pytest.fixture
+def webhook(app_client):
+    """Post events to the webhook with parser, agent and LINE API mocked."""
+    client, main_module = app_client
+    line_api = MagicMock()
+    line_api.reply_message = AsyncMock()
+    main_module.get_line_bot_api = lambda: line_api
+    from multi_tool_agent.ecommerce_agent import AgentReply
+    main_module.ecommerce_agent.reply = AsyncMock(return_value=AgentReply("回覆", None, None))
+
+    def post(*events):
+        main_module.parser.parse = MagicMock(return_value=list(events))
+        return client.post("/", content="{}", headers={"X-Line-Signature": "sig"})
+
+    yield post, main_module, line_api
+
+
+def test_webhook_throttles_chatty_user(webhook):
+    post, main_module, line_api = webhook
+    limit = main_module.USER_RATE_LIMIT
+    events = [make_text_event(f"msg{i}", "U_chatty") for i in range(limit + 1)]
+    assert post(*events).status_code == 200
+
+    assert main_module.ecommerce_agent.reply.await_count == limit
+    last_reply = line_api.reply_message.call_args_list[-1].args[1][0].text
+    assert last_reply == main_module.THROTTLED_REPLY
+    assert main_module.fairness.in_flight == 0
+
+
+def test_webhook_skips_redelivered_event(webhook):
+    post, main_module, line_api = webhook
+    event = make_text_event("有外套嗎", "U_redeliver", event_id="evt-redeliver")
+    post(event)
+    post(make_text_event("有外套嗎", "U_redeliver", event_id="evt-redeliver"))
+
+    assert main_module.ecommerce_agent.reply.await_count == 1
+    assert line_api.reply_message.await_count == 1
+    assert main_module.event_dedup.state("evt-redeliver") == "completed"
+
+
+def test_image_endpoint_sniffs_png_bytes(app_client):
+    client, main_module = app_client
+    test_id = str(uuid.uuid4())
+    main_module.image_cache[test_id] = b'\x89PNG\r\n\x1a\n' + b'\x00' * 10
+    response = client.get(f"/images/{test_id}")
+    assert response.headers["content-type"] == "image/png"
+
+
+@pytest.fixture
+def file_image(app_client, tmp_path):
+    """Register a file-backed image and return (client, url, file bytes)."""
+    client, main_module = app_client
+    data = b'\xff\xd8\xff\xe0' + bytes(range(256)) * 4
+    path = tmp_path / "product.jpg"
+    path.write_bytes(data)
+    test_id = str(uuid.uuid4())
+    main_module.image_cache[test_id] = str(path)
+    return client, f"/images/{test_id}", data
+
+
+def test_file_image_served_with_validators(file_image):
+    client, url, data = file_image
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.content == data
+    assert response.headers["content-type"] == "image/jpeg"
+    assert response.headers["content-length"] == str(len(data))
+    assert response.headers["accept-ranges"] == "bytes"
+    assert "etag" in response.headers
+    assert "last-modified" in response.headers
+
+
+def test_file_image_range_request(file_image):
+    client, url, data = file_image
+    response = client.get(url, headers={"Range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.content == data[10:20]
+    assert response.headers["content-range"] == f"bytes 10-19/{len(data)}"
+
+
+def test_file_image_conditional_get_returns_304(file_image):
+    client, url, _ = file_image
+    first = client.get(url)
+    by_etag = client.get(url, headers={"If-None-Match": first.headers["etag"]})
+    assert by_etag.status_code == 304
+    assert by_etag.content == b""
+    assert by_etag.headers["etag"] == first.headers["etag"]
+    by_date = client.get(url, headers={"If-Modified-Since": first.headers["last-modified"]})
+    assert by_date.status_code == 304
+    stale = client.get(url, headers={"If-None-Match": '"stale"'})
+    assert stale.status_code == 200
+
+
+def test_file_image_missing_file_404(app_client):
+    client, main_module = app_client
+    test_id = str(uuid.uuid4())
+    main_module.image_cache[test_id] = "/nonexistent/product.jpg"
+    assert client.get(f"/images/{test_id}").status_code == 404
+
+
+def test_webhook_caches_product_image_by_path(webhook):
+    post, main_module, line_api = webhook
+    from multi_tool_agent.ecommerce_agent import AgentReply
+    main_module.ecommerce_agent.reply.return_value = AgentReply(
+        "回覆", b'\xff\xd8', "/img/product.jpg"
+    )
+    post(make_text_event("有外套嗎", "U_image"))
+
+    image_message = line_api.reply_message.call_args.args[1][1]
+    image_id = image_message.original_content_url.rsplit("/", 1)[1]
+    assert main_module.image_cache[image_id] == "/img/product.jpg"
+
+
+def test_webhook_global_cap_sends_busy_reply(webhook):
+    post, main_module, line_api = webhook
+    main_module.fairness._in_flight = main_module.MAX_IN_FLIGHT
+    try:
+        post(make_text_event("有外套嗎", "U_calm"))
+    finally:
+        main_module.fairness._in_flight = 0
+
+    main_module.ecommerce_agent.reply.assert_not_awaited()
+    reply_text = line_api.reply_message.call_args.args[1][0].text
+    assert reply_text == main_module.BUSY_REPLY
+
+
+def test_startup_rejects_reserve_not_below_budget(patched_env):
+    env = {**os.environ, "AGENT_LATENCY_BUDGET": "5", "AGENT_FINAL_ANSWER_RESERVE": "8"}
+    result = subprocess.run(
+        [sys.executable, "-c", "import main"],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env=env, capture_output=True, text=True,
+    )
+    assert result.returncode == 1
+    assert "AGENT_FINAL_ANSWER_RESERVE" in result.stdout
+
+
+def test_gemini_quota_split_between_workers(patched_env, tmp_path):
+    with patch.dict("os.environ", {
+        "WEB_CONCURRENCY": "4",
+        "STATE_BACKEND": "sqlite",
+        "STATE_SQLITE_PATH": str(tmp_path / "state.db"),
+        "GEMINI_RPM": "60",
+        "GEMINI_TPM": "0",
+        "GEMINI_MAX_QUEUE": "100",
+    }), patch("multi_tool_agent.ecommerce_agent.genai.Client"):
+        sys.modules.pop("main", None)
+        import main
+        scheduler = main.ecommerce_agent._scheduler
+        assert scheduler._rpm._capacity == 15
+        assert scheduler._tpm is None
+        assert scheduler._max_queue == 25
+    sys.modules.pop("main", None)
@@ -0,0 +1,158 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from google.genai import errors
+
+from multi_tool_agent import metrics
+from multi_tool_agent.rate_limiter import (
+    PRIORITY_FIRST_TURN,
+    PRIORITY_FOLLOW_UP,
+    GeminiScheduler,
+    RateLimitExceeded,
+    TokenBucket,
+)
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def make_client(side_effect=None, return_value="ok"):
+    client = MagicMock()
+    client.aio.models.generate_content = AsyncMock(
+        side_effect=side_effect, return_value=return_value
+    )
+    return client
+
+
+class TestTokenBucket:
+    def test_starts_full_and_refills(self):
+        now = [0.0]
+        bucket = TokenBucket(60, clock=lambda: now[0])  # 1 token / second
+        assert bucket.delay_until(60) == 0
+        bucket.consume(60)
+        assert bucket.delay_until(1) == pytest.approx(1.0)
+        now[0] = 1.0
+        assert bucket.delay_until(1) == 0
+
+    def test_debt_delays_until_repaid(self):
+        now = [0.0]
+        bucket = TokenBucket(60, clock=lambda: now[0])
+        bucket.consume(70)
+        assert bucket.delay_until(0) == pytest.approx(10.0)
+
+
+@pytest.mark.asyncio
+async def test_passes_through_and_records_queue_wait():
+    client = make_client()
+    scheduler = GeminiScheduler(client)
+    assert await scheduler.generate_content(model="m", contents=[]) == "ok"
+    client.aio.models.generate_content.assert_awaited_once_with(model="m", contents=[])
+    assert metrics.get("gemini_queue_wait_seconds_count") == 1
+
+
+@pytest.mark.asyncio
+async def test_retries_quota_errors_with_backoff():
+    client = make_client(side_effect=[errors.ClientError(429, {}), "ok"])
+    scheduler = GeminiScheduler(client, backoff_base=0.001)
+    assert await scheduler.generate_content(model="m") == "ok"
+    assert client.aio.models.generate_content.await_count == 2
+    assert metrics.get("gemini_retries") == 1
+
+
+@pytest.mark.asyncio
+async def test_does_not_retry_client_errors():
+    client = make_client(side_effect=errors.ClientError(400, {}))
+    scheduler = GeminiScheduler(client, backoff_base=0.001)
+    with pytest.raises(errors.ClientError):
+        await scheduler.generate_content(model="m")
+    assert client.aio.models.generate_content.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_rejects_when_queue_full():
+    client = make_client()
+    scheduler = GeminiScheduler(client, max_queue=0)
+    with pytest.raises(RateLimitExceeded):
+        await scheduler.generate_content(model="m")
+    assert metrics.get("gemini_rejected") == 1
+    client.aio.models.generate_content.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_uses_fallback_model_when_queue_deep():
+    client = make_client()
+    scheduler = GeminiScheduler(client, fallback_model="cheap", fallback_queue_depth=0)
+    await scheduler.generate_content(model="m")
+    assert client.aio.models.generate_content.call_args.kwargs["model"] == "cheap"
+    assert metrics.get("gemini_fallback") == 1
+
+
+@pytest.mark.asyncio
+async def test_follow_up_requests_are_served_first():
+    order = []
+
+    async def record(model, **kwargs):
+        order.append(kwargs["tag"])
+
+    client = make_client(side_effect=record)
+    scheduler = GeminiScheduler(client, rpm=600)
+    scheduler._rpm.consume(600)  # exhaust the bucket so requests queue up
+
+    first = asyncio.ensure_future(
+        scheduler.generate_content(model="m", priority=PRIORITY_FIRST_TURN, tag="first")
+    )
+    await asyncio.sleep(0)
+    follow = asyncio.ensure_future(
+        scheduler.generate_content(model="m", priority=PRIORITY_FOLLOW_UP, tag="follow")
+    )
+    await asyncio.gather(first, follow)
+    assert order == ["follow", "first"]
+
+
+@pytest.mark.asyncio
+async def test_running_calls_count_toward_queue_depth():
+    release = asyncio.Event()
+
+    async def slow(model, **kwargs):
+        await release.wait()
+        return model
+
+    client = make_client(side_effect=slow)
+    scheduler = GeminiScheduler(
+        client, max_queue=3, fallback_model="cheap", fallback_queue_depth=2
+    )
+    calls = [asyncio.ensure_future(scheduler.generate_content(model="m")) for _ in range(3)]
+    await asyncio.sleep(0)
+    assert scheduler.queue_depth == 3
+    with pytest.raises(RateLimitExceeded):
+        await scheduler.generate_content(model="m")
+    release.set()
+    assert await asyncio.gather(*calls) == ["m", "m", "cheap"]
+    assert scheduler.queue_depth == 0
+
+
+@pytest.mark.asyncio
+async def test_tpm_precharges_estimate_before_usage_is_known():
+    started = []
+    release = asyncio.Event()
+
+    async def slow(model, **kwargs):
+        started.append(kwargs["tag"])
+        await release.wait()
+        return MagicMock(usage_metadata=MagicMock(total_token_count=100))
+
+    client = make_client(side_effect=slow)
+    scheduler = GeminiScheduler(client, tpm=6000, token_estimate=4000)
+    first = asyncio.ensure_future(scheduler.generate_content(model="m", tag="a"))
+    second = asyncio.ensure_future(scheduler.generate_content(model="m", tag="b"))
+    await asyncio.sleep(0.05)
+    assert started == ["a"]  # the estimate for "a" leaves too little for "b"
+    release.set()
+    await asyncio.gather(first, second)
+    assert started == ["a", "b"]
+    assert metrics.get("gemini_tokens") == 200
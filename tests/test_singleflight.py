@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from multi_tool_agent.singleflight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_share_one_execution():
+    sf = SingleFlight()
+    calls = 0
+    release = asyncio.Event()
+
+    async def work():
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        return "result"
+
+    tasks = [asyncio.ensure_future(sf.do("k", work)) for _ in range(3)]
+    await asyncio.sleep(0)
+    release.set()
+    results = await asyncio.gather(*tasks)
+
+    assert calls == 1
+    assert [r for r, _ in results] == ["result"] * 3
+    assert [shared for _, shared in results] == [False, True, True]
+    assert not sf.in_flight("k")
+
+
+@pytest.mark.asyncio
+async def test_different_keys_do_not_share():
+    sf = SingleFlight()
+
+    async def work():
+        return object()
+
+    (a, _), (b, _) = await asyncio.gather(sf.do("a", work), sf.do("b", work))
+    assert a is not b
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_does_not_cancel_others():
+    sf = SingleFlight()
+    release = asyncio.Event()
+
+    async def work():
+        await release.wait()
+        return 42
+
+    first = asyncio.ensure_future(sf.do("k", work))
+    second = asyncio.ensure_future(sf.do("k", work))
+    await asyncio.sleep(0)
+    first.cancel()
+    await asyncio.sleep(0)
+    release.set()
+
+    assert await second == (42, True)
+    assert first.cancelled()
+
+
+@pytest.mark.asyncio
+async def test_work_cancelled_when_all_waiters_leave():
+    sf = SingleFlight()
+    started = asyncio.Event()
+    cancelled = False
+
+    async def work():
+        nonlocal cancelled
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+
+    waiter = asyncio.ensure_future(sf.do("k", work))
+    await started.wait()
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    await asyncio.sleep(0)
+
+    assert cancelled
+    assert not sf.in_flight("k")
@@ -0,0 +1,245 @@
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+from unittest.mock import patch
+
+import httpx
+import pytest
+
+from multi_tool_agent.state import MemoryStore, RedisStore, SqliteStore, StoreMapping
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture
+def redis_server():
+    fakeredis = pytest.importorskip("fakeredis")
+    return fakeredis.FakeServer()
+
+
+def make_redis_store(server):
+    import fakeredis
+    with patch("redis.Redis.from_url", return_value=fakeredis.FakeRedis(server=server)):
+        return RedisStore("redis://localhost:6379/0")
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStore()
+    if request.param == "redis":
+        return make_redis_store(request.getfixturevalue("redis_server"))
+    return SqliteStore(str(tmp_path / "state.db"))
+
+
+class TestStateStore:
+    def test_set_get_delete(self, store):
+        store.set("ns", "k", {"a": [1, 2]})
+        assert store.get("ns", "k") == {"a": [1, 2]}
+        assert store.get("other", "k") is None
+        store.delete("ns", "k")
+        assert store.get("ns", "k") is None
+
+    def test_add_only_sets_absent_keys(self, store):
+        assert store.add("ns", "k", "first")
+        assert not store.add("ns", "k", "second")
+        assert store.get("ns", "k") == "first"
+
+    def test_incr(self, store):
+        assert store.incr("ns", "c") == 1
+        assert store.incr("ns", "c", 5) == 6
+        assert store.incr("ns", "c", 0) == 6
+
+    def test_get_counter_does_not_create_keys(self, store):
+        assert store.get_counter("ns", "missing") == 0
+        assert store.add("ns", "missing", "v")
+        store.incr("ns", "c", 3)
+        assert store.get_counter("ns", "c") == 3
+
+    def test_list_append_and_pop_all(self, store):
+        for item in ["a", "b", "c"]:
+            store.list_append("ns", "l", item, max_len=2, ttl=60)
+        assert store.list_pop_all("ns", "l") == ["b", "c"]
+        assert store.list_pop_all("ns", "l") == []
+
+    def test_expired_keys_are_gone(self, store):
+        store.set("ns", "k", "v", ttl=0.01)
+        time.sleep(0.02)
+        assert store.get("ns", "k") is None
+        assert store.add("ns", "k", "again")
+
+    def test_counter_is_readable_with_get(self, store):
+        store.incr("ns", "c", 2)
+        assert store.get("ns", "c") == 2
+
+    def test_counter_ttl_set_on_creation_only(self, store):
+        store.incr("ns", "c", 1, ttl=0.05)
+        store.incr("ns", "c", 1, ttl=60)
+        time.sleep(0.06)
+        assert store.get_counter("ns", "c") == 0
+
+    def test_list_items_expire(self, store):
+        store.list_append("ns", "l", "a", max_len=3, ttl=0.01)
+        time.sleep(0.02)
+        assert store.list_pop_all("ns", "l") == []
+
+
+def test_redis_store_shared_between_clients(redis_server):
+    worker_a = make_redis_store(redis_server)
+    worker_b = make_redis_store(redis_server)
+    assert worker_a.add("ns", "k", "a")
+    assert not worker_b.add("ns", "k", "b")
+    worker_a.incr("ns", "c", 1, ttl=60)
+    assert worker_b.incr("ns", "c", 1, ttl=60) == 2
+    worker_a.list_append("ns", "l", "x", max_len=3)
+    assert worker_b.list_pop_all("ns", "l") == ["x"]
+
+
+def test_redis_counters_always_expire(redis_server):
+    store = make_redis_store(redis_server)
+    store.incr("ns", "c", 1, ttl=60)
+    store.incr("ns", "c", -1)
+    ttl = store._redis.pttl(store._key("ns", "c"))
+    assert 0 < ttl <= 60_000
+
+
+def test_memory_store_ttl_and_eviction(clock):
+    store = MemoryStore(max_entries=2, clock=clock)
+    store.set("ns", "a", 1, ttl=10)
+    store.set("ns", "b", 2)
+    store.set("ns", "c", 3)
+    assert store.get("ns", "a") is None  # evicted, oldest
+    clock.now = 100
+    assert store.get("ns", "b") == 2
+
+
+def test_store_mapping_behaves_like_dict():
+    mapping = StoreMapping(MemoryStore(), "image")
+    mapping["x"] = b"data"
+    assert mapping["x"] == b"data"
+    assert "x" in mapping
+    assert mapping.get("missing") is None
+    with pytest.raises(KeyError):
+        mapping["missing"]
+
+
+def _worker(path: str, worker_id: int, rounds: int, results) -> None:
+    store = SqliteStore(path)
+    claimed = 0
+    for i in range(rounds):
+        store.incr("ns", "counter")
+        if store.add("events", f"evt-{i}", worker_id):
+            claimed += 1
+    store.set("images", f"worker-{worker_id}", os.getpid())
+    results.put(claimed)
+
+
+def test_sqlite_store_shared_by_worker_processes(tmp_path):
+    path = str(tmp_path / "state.db")
+    SqliteStore(path)
+    workers, rounds = 4, 50
+    results = multiprocessing.get_context("spawn").Queue()
+    procs = [
+        multiprocessing.get_context("spawn").Process(
+            target=_worker, args=(path, n, rounds, results)
+        )
+        for n in range(workers)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(timeout=60)
+        assert p.exitcode == 0
+
+    store = SqliteStore(path)
+    assert store.incr("ns", "counter", 0) == workers * rounds
+    # Each event id was claimed by exactly one worker
+    assert sum(results.get() for _ in range(workers)) == rounds
+    assert all(store.get("images", f"worker-{n}") for n in range(workers))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_uvicorn_workers_serve_images_from_shared_store(tmp_path):
+    """Images stored once are served by every uvicorn worker."""
+    db_path = str(tmp_path / "state.db")
+    port = _free_port()
+    env = {
+        **os.environ,
+        "ChannelSecret": "test-secret-12345678901234567890",
+        "ChannelAccessToken": "test-token",
+        "GOOGLE_API_KEY": "test-key",
+        "BOT_HOST_URL": "https://test.example.com",
+        "STATE_BACKEND": "sqlite",
+        "STATE_SQLITE_PATH": db_path,
+        "WEB_CONCURRENCY": "3",
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+         "--workers", "3"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        image_id = str(uuid.uuid4())
+        url = f"http://127.0.0.1:{port}/images/{image_id}"
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                httpx.get(url)
+                break
+            except httpx.TransportError:
+                assert time.monotonic() < deadline, "uvicorn did not start"
+                time.sleep(0.2)
+
+        StoreMapping(SqliteStore(db_path), "image")[image_id] = b"\xff\xd8shared"
+        for _ in range(30):
+            # A new connection per request spreads them over the workers
+            response = httpx.get(url, headers={"Connection": "close"})
+            assert response.status_code == 200
+            assert response.content == b"\xff\xd8shared"
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def test_incomplete_backend_fails_at_construction():
+    from multi_tool_agent.state import StateStore
+
+    class Incomplete(StateStore):
+        def get(self, namespace, key):
+            return None
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+@pytest.mark.asyncio
+async def test_offload_runs_shared_store_calls_off_the_loop(tmp_path):
+    import threading
+    from multi_tool_agent.state import offload
+
+    def current_thread():
+        return threading.get_ident()
+
+    loop_thread = threading.get_ident()
+    assert await offload(SqliteStore(str(tmp_path / "s.db")), current_thread) != loop_thread
+    assert await offload(MemoryStore(), current_thread) == loop_thread
+
+
+@pytest.mark.asyncio
+async def test_sqlite_store_usable_from_worker_threads(tmp_path):
+    import asyncio
+    store = SqliteStore(str(tmp_path / "s.db"))
+    await asyncio.gather(*(
+        asyncio.to_thread(store.incr, "ns", "c") for _ in range(20)
+    ))
+    assert store.get_counter("ns", "c") == 20